@@ -1,12 +1,26 @@
 
-import itertools
+import json
 import os
+from collections import OrderedDict, deque
+from functools import partial
 from hashlib import sha1
+from multiprocessing import Pool
 
+import numpy as np
 import yaml
 from bunch import Bunch
-from functools32 import lru_cache
-from pydub.silence import detect_silence
+from pydub.utils import db_to_float
+
+try:
+    from hashlib import blake2b
+except ImportError:  # python 2
+    blake2b = None
+
+try:
+    # libyaml based implementation is much faster
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 
 
 class Chunk(Bunch):
@@ -38,15 +52,53 @@ class Chunk(Bunch):
                      self.truth, self.label))
 
 
-def get_audio_hash(audio):
-    return sha1(audio.get_array_of_samples()).hexdigest()[:10]
+def get_audio_hash(audio, digest_size=5):
+    '''An identifier of the audio (short, by default), in hex.
+
+    No cryptographic strength is needed, so prefer blake2b (faster than sha1).
+    The raw data is hashed directly (without copying the samples).
+    digest_size (in bytes) is at most 20.
+
+    Audios are immutable, so each hash is computed only once per audio
+    and kept in it (as utils.load_audio keeps its filename).'''
+    hashes = vars(audio).setdefault('hashes', {})
+    if digest_size not in hashes:
+        data = memoryview(audio._data)
+        if blake2b:
+            hashes[digest_size] = blake2b(
+                data, digest_size=digest_size).hexdigest()
+        else:
+            hashes[digest_size] = sha1(data).hexdigest()[:2 * digest_size]
+    return hashes[digest_size]
 
 
 DATA_DIR = 'data'
 
 
-def get_audio_chunks_filename(audio):
-    chunks_extension = '.chunks.yaml'
+CHUNKS_EXTENSION = '.chunks.npy'
+# former formats of the chunks files, still loaded (once)
+LEGACY_CHUNKS_FORMATS = [
+    ('.chunks.json', json.load),
+    ('.chunks.yaml', lambda chunks_file: yaml.load(chunks_file,
+                                                   Loader=SafeLoader)),
+]
+
+
+# chunks are saved as a numpy array of records
+# (with empty truth and voice, instead of None)
+def chunks_dtype(truth_len, voice_len):
+    '''The dtype of the chunks records,
+    with text fields wide enough for the given lengths'''
+    return [('silence_start', np.int32),
+            ('start', np.int32),
+            ('end', np.int32),
+            ('level', np.int32),
+            ('truth', 'U%d' % max(truth_len, 1)),
+            ('label_voice', 'U%d' % max(voice_len, 1)),
+            ('label_probability', np.float64)]
+
+
+def get_audio_chunks_filename(audio, chunks_extension=CHUNKS_EXTENSION):
     if hasattr(audio, 'filename'):
         basename = os.path.splitext(audio.filename)[0]
         return basename + chunks_extension
@@ -58,17 +110,120 @@ def get_audio_chunks_filename(audio):
 def save_chunks(audio, chunks):
     if not os.path.exists(DATA_DIR):
         os.makedirs(DATA_DIR)
+    rows = [(c.silence_start, c.start, c.end, c.level, c.truth or u'') +
+            (tuple(c.label) if c.label else (u'', np.nan))
+            for c in chunks]
+    # the text fields are sized from the data (never truncated)
+    dtype = chunks_dtype(max([len(row[4]) for row in rows] or [0]),
+                         max([len(row[5]) for row in rows] or [0]))
+    records = np.array(rows, dtype=dtype)
     filename = get_audio_chunks_filename(audio)
-    with open(filename, 'w') as chunks_file:
-        yaml.safe_dump(chunks, chunks_file)
+    with open(filename, 'wb') as chunks_file:
+        np.save(chunks_file, records, allow_pickle=False)
 
 
 def load_chunks(audio):
     filename = get_audio_chunks_filename(audio)
     if os.path.exists(filename):
-        with open(filename, 'r') as chunks_file:
-            return [Chunk(**kwargs)
-                    for kwargs in yaml.safe_load(chunks_file)]
+        with open(filename, 'rb') as chunks_file:
+            records = np.load(chunks_file, allow_pickle=False)
+        return [Chunk(silence_start, start, end, level, truth or None,
+                      (voice, probability) if voice else None)
+                for (silence_start, start, end, level,
+                     truth, voice, probability) in records.tolist()]
+
+    # one time migration from the former formats
+    for chunks_extension, load in LEGACY_CHUNKS_FORMATS:
+        legacy_filename = get_audio_chunks_filename(audio, chunks_extension)
+        if os.path.exists(legacy_filename):
+            with open(legacy_filename, 'r') as chunks_file:
+                chunks = [Chunk(**kwargs) for kwargs in load(chunks_file)]
+            save_chunks(audio, chunks)
+            return chunks
+
+
+def get_energy_envelope(audio):
+    """Cumulative energy of the audio at each millisecond.
+
+    Returns a 2 x (len(audio) + 1) array:
+        first row: sum of the squared samples
+                   from the beginning of the audio up to each millisecond
+        second row: number of samples up to each millisecond
+
+    So the energy and number of samples of any range [start, end]
+    (in milliseconds) are given by envelope[:, end] - envelope[:, start]
+    """
+    # sample position of each millisecond (as in pydub slicing)
+    frames = (np.arange(len(audio) + 1) *
+              (audio.frame_rate / 1000.0)).astype(np.int64)
+    positions = frames * audio.channels
+
+    # square the samples in place (a single temporary array)
+    # and sum them by millisecond
+    # (exact integer sums up to 16 bits samples, as in audioop)
+    dtype = np.int64 if audio.sample_width <= 2 else np.float64
+    samples = np.frombuffer(audio._data, dtype=audio.array_type)
+    samples = samples[:positions[-1]].astype(dtype)
+    np.square(samples, out=samples)
+    # frames missing at the end count as silence in pydub
+    in_data = positions[:-1] < len(samples)
+    ms_energy = np.zeros(len(audio), dtype=dtype)
+    if in_data.any():
+        ms_energy[in_data] = np.add.reduceat(samples,
+                                             positions[:-1][in_data])
+
+    energy = np.concatenate([[0], np.cumsum(ms_energy)])
+    return np.vstack([energy, positions])
+
+
+def _windows_rms(envelope, min_silence_len, seek_step):
+    '''Start (in milliseconds) and rms of each window
+    tried when detecting silence (the same windows as in pydub)'''
+
+    seg_len = envelope.shape[1] - 1
+    last_slice_start = seg_len - min_silence_len
+    starts = np.arange(0, last_slice_start + 1, seek_step)
+    if last_slice_start % seek_step:
+        starts = np.append(starts, last_slice_start)
+    ends = starts + min_silence_len
+
+    energy, num_samples = envelope[:, ends] - envelope[:, starts]
+    mean_square = np.true_divide(energy, np.maximum(num_samples, 1))
+    # audioop.rms truncates the result to an integer
+    return starts, np.floor(np.sqrt(mean_square))
+
+
+def detect_silence(envelope, max_possible_amplitude, min_silence_len=1000,
+                   silence_thresh=-16, seek_step=1):
+    '''Returns a list of all silent ranges [start, end] in milliseconds.
+
+    Same results as pydub.silence.detect_silence, but the rms of every
+    window is computed at once from the energy envelope of the audio,
+    instead of slicing the audio and calling audioop.rms for each window.'''
+
+    seg_len = envelope.shape[1] - 1
+    if seg_len < min_silence_len:
+        return []
+
+    starts, rms = _windows_rms(envelope, min_silence_len, seek_step)
+    silent = rms <= db_to_float(silence_thresh) * max_possible_amplitude
+
+    # runs of silent windows, from the transitions in the mask
+    # (as pairs of indexes of their first and last windows)
+    transitions = np.flatnonzero(np.diff(
+        np.concatenate([[False], silent, [False]]).view(np.int8)))
+    runs = transitions.reshape(-1, 2) - [0, 1]
+    if not len(runs):
+        return []
+    run_starts, run_last_starts = starts[runs[:, 0]], starts[runs[:, 1]]
+
+    # combine the runs into ranges:
+    # a new range begins after a gap greater than the window length
+    gaps = run_starts[1:] - run_last_starts[:-1]
+    breaks = np.flatnonzero(gaps > min_silence_len)
+    range_starts = run_starts[np.append(0, breaks + 1)]
+    range_ends = run_last_starts[np.append(breaks, -1)] + min_silence_len
+    return np.column_stack([range_starts, range_ends]).tolist()
 
 
 SILENCE_LEVELS = [{'silence_thresh': t, 'min_silence_len': l}
@@ -76,91 +231,200 @@ SILENCE_LEVELS = [{'silence_thresh': t, 'min_silence_len': l}
                   for l in range(500, 100, -100)]
 
 
-def detect_silence_and_audible(audio_segment, level=0):
-    '''Splits audios segments in chunks separated by silence.
+def detect_silence_and_audible(envelope, max_possible_amplitude, level=0,
+                               offset=0, silent_ranges=None):
+    '''Splits audios segments (given by their energy envelope)
+    in chunks separated by silence.
     Keep the silence in the beginning of each chunk, as possible,
-    and ignore silence after the last chunk.'''
+    and ignore silence after the last chunk.
 
-    silent_ranges = detect_silence(audio_segment, seek_step=10,
-                                   **SILENCE_LEVELS[level])
-    len_seg = len(audio_segment)
+    Returns an array with a row [silence_start, start, end, level]
+    for each chunk (see Chunk).
+    The chunks positions are shifted by offset
+    (the start of the envelope in the whole audio).
+
+    The silent ranges are detected in the envelope, if not given.'''
+
+    if silent_ranges is None:
+        silent_ranges = detect_silence(envelope, max_possible_amplitude,
+                                       seek_step=10, **SILENCE_LEVELS[level])
+    len_seg = envelope.shape[1] - 1
 
     # make sure there is a silence at the beginning (even an empty one)
-    if not silent_ranges or silent_ranges[0][0] is not 0:
+    if not silent_ranges or silent_ranges[0][0] != 0:
         silent_ranges.insert(0, (0, 0))
     # make sure there is a silence at the end (even an empty one)
-    if silent_ranges[-1][1] is not len_seg:
+    if silent_ranges[-1][1] != len_seg:
         silent_ranges.append((len_seg, len_seg))
 
-    return [Chunk(silence_start, start, end, level)
-            for (silence_start, start), (end, __) in zip(silent_ranges,
-                                                         silent_ranges[1:])]
+    silent_ranges = np.array(silent_ranges, dtype=np.int32) + offset
+    chunks = np.empty((len(silent_ranges) - 1, 4), dtype=np.int32)
+    chunks[:, :2] = silent_ranges[:-1]    # silence start, start
+    chunks[:, 2] = silent_ranges[1:, 0]   # end
+    chunks[:, 3] = level
+    return chunks
+
 
+def first_level_with_silence(envelope, max_possible_amplitude, level=0,
+                             seek_step=10):
+    '''The first silence level (from level on) at which
+    some silence would be detected, or None if there is none.
 
-def seek_split(audio, level=0):
+    For each min_silence_len only the quietest window is computed,
+    so each level costs just a comparison with its threshold.'''
+
+    seg_len = envelope.shape[1] - 1
+    quietest = {}
     for level in range(level, len(SILENCE_LEVELS)):
-        chunks = detect_silence_and_audible(audio, level)
+        min_silence_len = SILENCE_LEVELS[level]['min_silence_len']
+        silence_thresh = SILENCE_LEVELS[level]['silence_thresh']
+        if seg_len < min_silence_len:
+            continue
+        if min_silence_len not in quietest:
+            __, rms = _windows_rms(envelope, min_silence_len, seek_step)
+            quietest[min_silence_len] = rms.min()
+        if (quietest[min_silence_len] <=
+                db_to_float(silence_thresh) * max_possible_amplitude):
+            return level
+
+
+def seek_split(envelope, max_possible_amplitude, offset, level=0):
+    # skip at once the levels where there is no silence at all
+    first_level = first_level_with_silence(envelope, max_possible_amplitude,
+                                           level)
+    if first_level is None:
+        # nothing to split (a single chunk)
+        return detect_silence_and_audible(
+            envelope, max_possible_amplitude, len(SILENCE_LEVELS) - 1,
+            offset, silent_ranges=[])
+    for level in range(first_level, len(SILENCE_LEVELS)):
+        chunks = detect_silence_and_audible(
+            envelope, max_possible_amplitude, level, offset)
         if len(chunks) > 1:
             return chunks
     else:
         return chunks
 
 
-def _gen_join_almost_silent(chunks, min_audible_len):
-    'join each almost silent chunk as a silence beginning the following one'
+def _join_almost_silent(chunks, min_audible_len):
+    '''Join each almost silent chunk as a silence beginning the following one.
+    Note that more than one "almost silence" can accumulate.
+
+    The chunks are given (and returned) as an array of rows
+    [silence_start, start, end, level].'''
+
+    kept = np.flatnonzero(chunks[:, 2] - chunks[:, 1] >= min_audible_len)
+    joined = chunks[kept]
+    # each kept chunk takes as its silence start the silence start
+    # of the first chunk following the previous kept one
+    joined[:, 0] = chunks[np.append(0, kept[:-1] + 1)[:len(kept)], 0]
+    return joined
+
+
+# chunks already got in this process, the least recently used dropped first.
+# The very same chunks are returned for the same audio, so that changes
+# to them (e.g. truth and label) are seen by every caller
+CHUNKS_CACHE_SIZE = 128
+_CHUNKS_CACHE = OrderedDict()
+
+
+def _chunks_cache_key(audio, min_audible_len=300, target_audible_len=2000):
+    # a full length digest: a collision here would mix up two audios
+    return (get_audio_hash(audio, digest_size=20),
+            min_audible_len, target_audible_len)
 
-    almost_silence_start = None
-    for chunk in chunks:
-        if chunk.audible_len < min_audible_len:
-            # remember for following silence start
-            # note that more than one "almost silence" can accumulate
-            almost_silence_start = almost_silence_start or chunk.silence_start
-        else:
-            if almost_silence_start:
-                chunk.silence_start = almost_silence_start
-                almost_silence_start = None  # reset
-            yield chunk
+
+def _get_cached_chunks(key):
+    chunks = _CHUNKS_CACHE.pop(key, None)
+    if chunks is not None:
+        _CHUNKS_CACHE[key] = chunks  # now the most recently used
+    return chunks
+
+
+def _cache_chunks(key, chunks):
+    '''Keeps the chunks in memory, unless there are some already for key.
+    Returns the chunks kept.'''
+    chunks = _CHUNKS_CACHE.pop(key, chunks)
+    _CHUNKS_CACHE[key] = chunks
+    while len(_CHUNKS_CACHE) > CHUNKS_CACHE_SIZE:
+        _CHUNKS_CACHE.popitem(last=False)
+    return chunks
 
 
-@lru_cache()
 def get_chunks(audio, min_audible_len=300, target_audible_len=2000,
                load_if_available=True):
 
-    # try to load from disk
+    key = _chunks_cache_key(audio, min_audible_len, target_audible_len)
     if load_if_available:
+        cached = _get_cached_chunks(key)
+        if cached is not None:
+            return cached
+        # try to load from disk
         loaded = load_chunks(audio)
         if loaded:
-            return loaded
-
-    chunks = detect_silence_and_audible(audio)
-    for iteration in itertools.count(1):
-        for pos, chunk in enumerate(chunks):
-            if (chunk.audible_len > target_audible_len and
-                    chunk.level + 1 < len(SILENCE_LEVELS)):
-                subsplit = seek_split(chunk.cut(audio),
-                                      chunk.level + 1)
-                if len(subsplit) > 1:
-                    # shift all sub chunks by "start"
-                    # notice the previous label is discarded after splitting
-                    for sub in subsplit:
-                        sub.silence_start += chunk.start
-                        sub.start += chunk.start
-                        sub.end += chunk.start
-                        # keep ground truth after split
-                        sub.truth = chunk.truth
-                    # attach previous silence to first chunk of subsplit
-                    subsplit[0].silence_start = chunk.silence_start
-                    # the end of the last sub chunk must
-                    # be the silence start of next global chunk
-                    if pos + 1 < len(chunks):
-                        chunks[pos + 1].silence_start = subsplit[-1].end
-                    # replace chunk with it's subsplit
-                    chunks[pos:pos + 1] = subsplit
-                    break
-        else:
-            # there's nothing more to split
-            break
-
-    chunks = list(_gen_join_almost_silent(chunks, min_audible_len))
+            return _cache_chunks(key, loaded)
+
+    # the audio is split in "index space", through views of its envelope
+    # (no audio slices are created)
+    envelope = get_energy_envelope(audio)
+    # chunks are taken in order from the pending ones
+    # and either replaced by their subsplit or considered done
+    # (all chunks are rows [silence_start, start, end, level])
+    pending = deque(detect_silence_and_audible(
+        envelope, audio.max_possible_amplitude).tolist())
+    done = []
+    while pending:
+        silence_start, start, end, level = chunk = pending.popleft()
+        if (end - start > target_audible_len and
+                level + 1 < len(SILENCE_LEVELS)):
+            subsplit = seek_split(envelope[:, start:end + 1],
+                                  audio.max_possible_amplitude,
+                                  start, level + 1).tolist()
+            if len(subsplit) > 1:
+                # attach previous silence to first chunk of subsplit
+                subsplit[0][0] = silence_start
+                # the end of the last sub chunk must
+                # be the silence start of next global chunk
+                if pending:
+                    pending[0][0] = subsplit[-1][2]
+                # the sub chunks are the next ones to be processed
+                pending.extendleft(reversed(subsplit))
+                continue
+        done.append(chunk)
+
+    done = np.array(done, dtype=np.int32).reshape(-1, 4)
+    chunks = [Chunk(*row)
+              for row in _join_almost_silent(done, min_audible_len).tolist()]
     save_chunks(audio, chunks)
-    return chunks
+    _CHUNKS_CACHE.pop(key, None)  # recomputed: replace any former ones
+    return _cache_chunks(key, chunks)
+
+
+def get_chunks_batch(audios, min_audible_len=300, target_audible_len=2000,
+                     processes=None):
+    '''Get the chunks of each audio, computing them in parallel processes
+    (by default, as many as cpus).
+
+    As in get_chunks, the chunks already in memory are reused,
+    the others are loaded from disk if available,
+    or saved to disk after computed.'''
+
+    keys = [_chunks_cache_key(audio, min_audible_len, target_audible_len)
+            for audio in audios]
+    chunks_list = [_get_cached_chunks(key) for key in keys]
+    # only the audios not in memory are sent to the worker processes
+    missing = [i for i, chunks in enumerate(chunks_list) if chunks is None]
+    if missing:
+        pool = Pool(processes)
+        try:
+            computed = pool.map(
+                partial(get_chunks, min_audible_len=min_audible_len,
+                        target_audible_len=target_audible_len),
+                [audios[i] for i in missing])
+        finally:
+            pool.close()
+            pool.join()
+        # keep them for the following get_chunks in this process
+        for i, chunks in zip(missing, computed):
+            chunks_list[i] = _cache_chunks(keys[i], chunks)
+    return chunks_list
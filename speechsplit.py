@@ -6,12 +6,16 @@ import numpy as np
 import pandas as pd
 import python_speech_features
 from choice import Menu
-from functools32 import lru_cache
 from sklearn.svm import SVC
 
 from fragmentation import Chunk, get_chunks
 from utils import flatten, load_audio, play, save_yaml, timerepr
 
+try:
+    from functools import lru_cache
+except ImportError:  # python 2
+    from functools32 import lru_cache
+
 # FEATURES ###################################################################
 
 
@@ -1,9 +1,19 @@
+import json
+import os
+
+import numpy as np
 import pytest
-from mock import MagicMock, patch
+import yaml
+from mock import patch
+from pydub import AudioSegment
 from pydub.generators import Sine
+from pydub.silence import detect_silence as pydub_detect_silence
 
-from fragmentation import (Chunk, detect_silence_and_audible, get_chunks,
-                           load_chunks, save_chunks)
+from fragmentation import (SILENCE_LEVELS, Chunk, _join_almost_silent,
+                           detect_silence, detect_silence_and_audible,
+                           first_level_with_silence, get_audio_chunks_filename,
+                           get_audio_hash, get_chunks, get_chunks_batch,
+                           get_energy_envelope, load_chunks, save_chunks)
 
 
 @pytest.mark.parametrize('silence_ranges, split_ranges', [
@@ -24,23 +34,90 @@ from fragmentation import (Chunk, detect_silence_and_audible, get_chunks,
 ])
 def test_detect_silence_and_audible(silence_ranges, split_ranges):
 
-    audio_stub = MagicMock()
-    audio_stub.__len__.return_value = 100
+    envelope = np.zeros((2, 101))  # 100 ms long
+    amplitude = 2 ** 15
 
     with patch('fragmentation.detect_silence',
                return_value=silence_ranges) as mock_detect_silence:
 
         assert split_ranges == [
-            [c.silence_start, c.start, c.end]
-            for c in detect_silence_and_audible(audio_stub, 0)]
+            c[:3] for c in
+            detect_silence_and_audible(envelope, amplitude, 0).tolist()]
         mock_detect_silence.assert_called_once()
-        assert (audio_stub,) == mock_detect_silence.call_args[0]
+        assert envelope is mock_detect_silence.call_args[0][0]
+        assert amplitude == mock_detect_silence.call_args[0][1]
+
+        # positions are shifted by offset
+        offset = 1000
+        assert [[x + offset for x in r] for r in split_ranges] == [
+            c[:3] for c in
+            detect_silence_and_audible(envelope, amplitude, 0,
+                                       offset).tolist()]
+
+
+def test_detect_silence_and_audible_long_segment():
+    # positions beyond the small integers cached by python
+    envelope = np.zeros((2, 1001))  # 1000 ms long
+    with patch('fragmentation.detect_silence',
+               return_value=[[300, 400], [700, 1000]]):
+        assert [[0, 0, 300, 0], [300, 400, 700, 0]] == \
+            detect_silence_and_audible(envelope, 2 ** 15, 0).tolist()
+
+
+@pytest.mark.parametrize('chunks, joined', [
+    ([], []),
+    # nothing to join
+    ([[0, 10, 500, 0], [500, 600, 1000, 0]],
+     [[0, 10, 500, 0], [500, 600, 1000, 0]]),
+    # almost silent in the middle
+    ([[0, 10, 500, 0], [500, 600, 700, 1], [700, 800, 1200, 0]],
+     [[0, 10, 500, 0], [500, 800, 1200, 0]]),
+    # many almost silent accumulate (also at the beginning)
+    ([[0, 10, 20, 0], [20, 30, 40, 0], [40, 50, 500, 1], [500, 510, 520, 0]],
+     [[0, 50, 500, 1]]),
+    # nothing left
+    ([[0, 10, 20, 0]], []),
+])
+def test_join_almost_silent(chunks, joined):
+    chunks = np.array(chunks, dtype=np.int32).reshape(-1, 4)
+    assert joined == _join_almost_silent(chunks, 300).tolist()
 
 
 HI = Sine(440).to_audio_segment(1000)
 LO = HI.apply_gain(-50)
 
-get_chunks = get_chunks.__wrapped__  # remove lru cache for testing
+
+def noise(seconds, frame_rate=16000, seed=0):
+    '''Noise with a loudness changing every 50ms,
+    often around the silence thresholds'''
+    random = np.random.RandomState(seed)
+    num_frames = seconds * frame_rate
+    amplitude = np.repeat(random.choice([.003, .008, .01, .013, .3],
+                                        seconds * 20), frame_rate // 20)
+    samples = random.randn(num_frames) * amplitude * 2 ** 15
+    return AudioSegment(samples.astype(np.int16).tobytes(),
+                        frame_rate=frame_rate, sample_width=2, channels=1)
+
+
+@pytest.mark.parametrize('audio', [noise(8), noise(5, 44100, 1)[137:]])
+def test_detect_silence_as_pydub(audio):
+    envelope = get_energy_envelope(audio)
+    for level in SILENCE_LEVELS:
+        assert pydub_detect_silence(audio, seek_step=10, **level) == \
+            detect_silence(envelope, audio.max_possible_amplitude,
+                           seek_step=10, **level)
+
+
+@pytest.mark.parametrize('audio, level, first_level', [
+    (HI * 3, 0, None),              # no silence at all
+    (HI + LO + HI, 0, 0),
+    (HI + LO + HI, 5, 5),
+    (HI + HI.apply_gain(-38) + HI, 0, 4),  # rms of -41 dBFS
+    (HI + HI.apply_gain(-38)[:300] + HI, 0, 6),  # short silence
+])
+def test_first_level_with_silence(audio, level, first_level):
+    assert first_level == first_level_with_silence(
+        get_energy_envelope(audio), audio.max_possible_amplitude, level)
 
 
 @pytest.mark.parametrize('chunks, target_audible_len', [
@@ -62,10 +139,130 @@ def test_get_chunks(chunks, target_audible_len):
         assert audio == sum(audio[c.silence_start:c.end] for c in chunks)
 
 
-def test_save_and_load_fragments(tmpdir):
+def test_get_chunks_is_cached_in_memory():
+    audio = LO + HI * 3
+    with patch('fragmentation.save_chunks'), \
+            patch.dict('fragmentation._CHUNKS_CACHE', clear=True):
+        chunks = get_chunks(audio, load_if_available=False)
+        with patch('fragmentation.load_chunks') as mock_load_chunks:
+            # the very same chunks, not even loaded from disk
+            # (nor hashing the audio data again)
+            with patch('fragmentation.memoryview', create=True) as mock_data:
+                assert chunks is get_chunks(audio)
+                assert not mock_data.called
+            # any other audio with the same data
+            assert chunks is get_chunks(audio[:])
+            assert not mock_load_chunks.called
+        # not for other parameters
+        assert chunks is not get_chunks(audio, target_audible_len=1000,
+                                        load_if_available=False)
+
+
+def test_get_chunks_cache_is_bounded():
+    a, b, c = [LO + HI * n for n in (1, 2, 3)]
+    with patch('fragmentation.save_chunks'), \
+            patch('fragmentation.load_chunks', return_value=None), \
+            patch('fragmentation.CHUNKS_CACHE_SIZE', 2), \
+            patch.dict('fragmentation._CHUNKS_CACHE', clear=True):
+        chunks_a, chunks_b = get_chunks(a), get_chunks(b)
+        assert chunks_a is get_chunks(a)  # now used more recently than b
+        get_chunks(c)
+        assert chunks_a is get_chunks(a)
+        # the least recently used was dropped (and so computed again)
+        assert chunks_b is not get_chunks(b)
+        assert chunks_b == get_chunks(b)
+
+
+def test_get_chunks_batch(tmpdir):
+    audios = [LO + HI * 3, LO + HI * 2 + LO + HI * 2]
+    with patch('fragmentation.DATA_DIR', str(tmpdir)), \
+            patch.dict('fragmentation._CHUNKS_CACHE', clear=True):
+        batch_chunks = get_chunks_batch(audios, processes=2)
+        # the chunks were saved to disk by the worker processes
+        assert batch_chunks == [load_chunks(audio) for audio in audios]
+        assert batch_chunks == [
+            get_chunks(audio, load_if_available=False) for audio in audios]
+
+
+def test_get_chunks_batch_computes_only_missing_chunks(tmpdir):
+    cached, missing = LO + HI * 3, LO + HI * 2 + LO + HI * 2
+    with patch('fragmentation.DATA_DIR', str(tmpdir)), \
+            patch.dict('fragmentation._CHUNKS_CACHE', clear=True):
+        cached_chunks = get_chunks(cached, target_audible_len=1000)
+        with patch('fragmentation.Pool') as mock_pool:
+            mock_pool.return_value.map.return_value = [['computed']]
+            batch_chunks = get_chunks_batch([cached, missing],
+                                            target_audible_len=1000)
+        (function, audios), __ = mock_pool.return_value.map.call_args
+        assert audios == [missing]
+        assert function.keywords == {'min_audible_len': 300,
+                                     'target_audible_len': 1000}
+        assert batch_chunks == [cached_chunks, ['computed']]
+        assert batch_chunks[0] is cached_chunks
+        # nothing missing, no processes at all
+        with patch('fragmentation.Pool') as mock_pool:
+            assert batch_chunks == get_chunks_batch([cached, missing],
+                                                    target_audible_len=1000)
+            assert not mock_pool.called
+
+
+def test_get_audio_hash():
+    audio = LO + HI * 2
+    assert get_audio_hash(audio) == get_audio_hash(LO + HI + HI)
+    assert get_audio_hash(audio) != get_audio_hash(HI * 3)
+    # prefixes of one another
+    assert get_audio_hash(audio) != get_audio_hash(LO + HI)
+    assert get_audio_hash(audio) != get_audio_hash(LO + HI * 3)
+    # same beginning and length, differing only later on
+    assert get_audio_hash(LO + HI * 3 + LO * 2 + HI * 3) != \
+        get_audio_hash(LO + HI * 3 + HI * 3 + LO * 2)
+    assert len(get_audio_hash(audio)) == 10
+    assert len(get_audio_hash(audio, digest_size=20)) == 40
+
+
+def test_get_audio_hash_is_computed_once_per_audio(tmpdir):
+    audio = LO + HI * 2
+    audio_hash = get_audio_hash(audio)
+    with patch('fragmentation.memoryview', create=True) as mock_data, \
+            patch('fragmentation.DATA_DIR', str(tmpdir)):
+        assert audio_hash == get_audio_hash(audio)
+        assert get_audio_chunks_filename(audio) == str(
+            tmpdir.join(audio_hash + '.chunks.npy'))
+        assert not mock_data.called
+
+
+@pytest.mark.parametrize('chunks', [
+    [],
+    [Chunk(0, 1, 2, 3),
+     Chunk(5, 6, 7, 8, 'TRUTH', ('speaker', .9))],
+    # texts of any length
+    [Chunk(0, 1, 2, 3, 'A' * 40),
+     Chunk(5, 6, 7, 8, 'B', ('a speaker with a long name', .9))],
+])
+def test_save_and_load_fragments(tmpdir, chunks):
+    audio = HI
+    with patch('fragmentation.DATA_DIR', str(tmpdir)):
+        save_chunks(audio, chunks)
+        assert chunks == load_chunks(audio)
+
+
+@pytest.mark.parametrize('chunks_extension, dump', [
+    ('.chunks.json', json.dump),
+    ('.chunks.yaml', yaml.safe_dump),
+])
+def test_load_fragments_migrates_legacy_formats(tmpdir, chunks_extension,
+                                                dump):
     audio = HI
     chunks = [Chunk(0, 1, 2, 3),
               Chunk(5, 6, 7, 8, 'TRUTH', ['speaker', .9])]
     with patch('fragmentation.DATA_DIR', str(tmpdir)):
-        save_chunks(audio, chunks)
+        legacy_filename = get_audio_chunks_filename(audio, chunks_extension)
+        with open(legacy_filename, 'w') as legacy_file:
+            dump(chunks, legacy_file)
+
         assert chunks == load_chunks(audio)
+        # the chunks are now available in the new format
+        os.remove(legacy_filename)
+        migrated = load_chunks(audio)
+        assert chunks[0] == migrated[0]
+        assert ('speaker', .9) == migrated[1].label